@@ -19,24 +19,51 @@ import sys
 import os
 import argparse
 from pathlib import Path
-from Bio import SeqIO
+from Bio.SeqIO.FastaIO import SimpleFastaParser
 from Bio import AlignIO
 from Bio.Align import AlignInfo
 import subprocess
 import multiprocessing as mp
+from multiprocessing.pool import ThreadPool
 import shutil
 from tqdm import tqdm
 import time
 from datetime import datetime
-import statistics
-from scipy import stats
-from rpy2.robjects import FloatVector
-from rpy2.robjects.packages import importr
+from collections import defaultdict
+from functools import lru_cache
+import numpy as np
+import json
+import pickle
+from scipy.stats import chi2
 
 def checkFileExist(file):
     if not os.path.exists(os.path.abspath(file)):
         sys.exit('%s not found' % file)
 
+def listFiles(dir):
+    # snapshot of a directory, for membership tests without one stat per file
+    return({d.name for d in os.scandir(dir)})
+
+@lru_cache(maxsize=None)
+def getRefGenome(blastDir, ref):
+    # ref genomes are shared by all groups, resolve each only once
+    refGenome = '%s/%s/%s.fa' % (blastDir, ref, ref)
+    if not os.path.exists(refGenome):
+        if os.path.islink(refGenome):
+            refGenome = os.path.realpath(refGenome)
+        else:
+            sys.exit('%s not found!' % refGenome)
+    checkFileExist(refGenome)
+    return(refGenome)
+
+def hasCutoff(file):
+    # cutoff file exists and holds more than its header line
+    if not os.path.exists(file):
+        return(False)
+    with open(file, 'r') as f:
+        next(f, None)
+        return(next(f, None) is not None)
+
 def roundTo4(number):
     return("%.4f" % round(number, 4))
 
@@ -44,13 +71,76 @@ def annoFAS(groupFa, annoDir, cpus, force):
     ### CAN BE IMPROVED!!!
     ### by modify seq IDs in groupFa, then use extract option of annoFAS
     ### and replace mod IDs by original IDs again in the annotaion json file
-    annoFAS = 'annoFAS -i %s -o %s --cpus %s > /dev/null 2>&1' % (groupFa, annoDir, cpus)
+    annoFAS = ['annoFAS', '-i', groupFa, '-o', annoDir, '--cpus', str(cpus)]
     if force:
-        annoFAS = annoFAS + ' --force'
+        annoFAS.append('--force')
     try:
-        subprocess.run([annoFAS], shell=True, check=True)
+        subprocess.run(annoFAS, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL, check=True)
     except:
-        print('\033[91mProblem occurred while running annoFAS\033[0m\n%s' % annoFAS)
+        print('\033[91mProblem occurred while running annoFAS\033[0m\n%s' % ' '.join(annoFAS))
+
+def readGroupFa(groupFa):
+    # IDs and lengths of all sequences in groupFa
+    seqIDs = []
+    lengths = []
+    with open(groupFa, 'r') as f:
+        for (title, seq) in SimpleFastaParser(f):
+            seqIDs.append(title.split(None, 1)[0])
+            lengths.append(len(seq))
+    return(seqIDs, lengths)
+
+def countFeatures(features):
+    # number of instances of each feature, as annoFAS countFeatures
+    # (instances are a plain list in older greedyFAS versions)
+    count = {}
+    for seqID in features:
+        for tool in features[seqID]:
+            if not tool == 'length':
+                for featID in features[seqID][tool]:
+                    feature = features[seqID][tool][featID]
+                    if isinstance(feature, dict) and 'instance' in feature:
+                        feature = feature['instance']
+                    count[featID] = count.get(featID, 0) + len(feature)
+    return(count)
+
+def mergeAnno(seqIDs, annoDir, annoFiles):
+    # build annotation of seqIDs from the existing ref spec annotations in annoDir
+    # return None if any sequence is not covered, so annoFAS can be used instead
+    refAnno = {}
+    merged = {}
+    merged['feature'] = {}
+    for seqID in seqIDs:
+        tmp = seqID.split('|')
+        ref = tmp[1]
+        if not ref in refAnno:
+            if not '%s.json' % ref in annoFiles:
+                return(None)
+            refJson = '%s/%s.json' % (annoDir, ref)
+            with open(refJson, 'r') as f:
+                refAnno[ref] = json.load(f)
+        features = refAnno[ref].get('feature', {})
+        anno = None
+        for protID in (seqID, '|'.join(tmp[1:]), '|'.join(tmp[2:])):
+            if protID in features:
+                anno = features[protID]
+                break
+        if anno is None:
+            return(None)
+        merged['feature'][seqID] = anno
+    # count is recomputed for the group, clan, interproID and the pHMM
+    # lengths are merged over all ref specs and limited to the group's features
+    merged['count'] = countFeatures(merged['feature'])
+    for ref in refAnno:
+        for key in refAnno[ref]:
+            if key in ('clan', 'interproID', 'length'):
+                if not key in merged:
+                    merged[key] = {}
+                for featID in refAnno[ref][key]:
+                    if featID in merged['count']:
+                        merged[key][featID] = refAnno[ref][key][featID]
+            elif not key in merged:
+                merged[key] = refAnno[ref][key]
+    return(merged)
 
 def getConsensus(alignmentFile, cov):
     alignment = AlignIO.read(alignmentFile, 'fasta')
@@ -59,88 +149,100 @@ def getConsensus(alignmentFile, cov):
     return(consensus)
 
 def prepareJob(coreDir, coreSet, annoDir, blastDir, bidirectional, force, cpus):
-    groups = os.listdir(coreDir + '/core_orthologs/' + coreSet)
+    # sorted, so reruns visit the groups in the same order
+    groups = sorted(d.name for d in os.scandir(coreDir + '/core_orthologs/' + coreSet) if d.is_dir())
     fasJobs = []
     fasJobsCons = []
     groupRefSpec = {}
-    if not os.path.exists('%s/core_orthologs/%s/done.txt' % (coreDir, coreSet)):
+    if not os.path.exists('%s/core_orthologs/%s/done.txt' % (coreDir, coreSet)) or force:
         if len(groups) > 0:
-            for groupID in groups:
-                groupRefSpec[groupID] = []
+            annoFiles = listFiles(annoDir)
+            for groupID in tqdm(groups, desc='preparing'):
                 group = '%s/core_orthologs/%s/%s' % (coreDir, coreSet, groupID)
-                if os.path.isdir(group):
-                    print(groupID)
-                    groupFa = '%s/%s.fa' % (group, groupID)
-                    annoDirTmp = '%s/fas_dir/annotation_dir/' % (group)
-                    Path(annoDirTmp).mkdir(parents=True, exist_ok=True)
-                    outDir = '%s/fas_dir/fasscore_dir/' % (group)
-                    Path(outDir).mkdir(parents=True, exist_ok=True)
-                    # check existing cutoff files
-                    flag = 0
-                    if os.path.exists('%s/fas_dir/cutoff_dir/1.cutoff' % (group)):
-                        if not os.stat('%s/fas_dir/cutoff_dir/1.cutoff' % (group)).st_size == 0:
-                            flag = 1
-                    if flag == 0:
-                        # do annotation for this group
-                        if not os.path.exists('%s/%s.json' % (annoDirTmp, groupID)) or force:
+                groupFa = '%s/%s.fa' % (group, groupID)
+                annoDirTmp = '%s/fas_dir/annotation_dir/' % (group)
+                Path(annoDirTmp).mkdir(parents=True, exist_ok=True)
+                outDir = '%s/fas_dir/fasscore_dir/' % (group)
+                Path(outDir).mkdir(parents=True, exist_ok=True)
+                # check existing cutoff files
+                flag = 0
+                if not force:
+                    cutoffDir = '%s/fas_dir/cutoff_dir' % (group)
+                    if hasCutoff('%s/1.cutoff' % cutoffDir) and os.path.exists('%s/2.cutoff' % cutoffDir):
+                        flag = 1
+                if flag == 0:
+                    annoTmpFiles = listFiles(annoDirTmp)
+                    outFiles = listFiles(outDir)
+                    (seqIDs, lengths) = readGroupFa(groupFa)
+                    groupRefSpec[groupID] = {'refs': [], 'lengths': lengths}
+                    # do annotation for this group
+                    if not '%s.json' % groupID in annoTmpFiles or force:
+                        merged = mergeAnno(seqIDs, annoDir, annoFiles)
+                        if merged is not None:
+                            with open('%s/%s.json' % (annoDirTmp, groupID), 'w') as f:
+                                json.dump(merged, f)
+                        else:
                             annoFAS(groupFa, annoDirTmp, cpus, force)
-                        # get annotation for ref genomes and path to ref genomes
-                        for s in SeqIO.parse(groupFa, 'fasta'):
-                            ref = s.id.split('|')[1]
-                            if not os.path.exists('%s/%s.json' % (annoDirTmp, ref)):
-                                if os.path.exists('%s/%s.json' % (annoDir, ref)):
-                                    src = '%s/%s.json' % (annoDir, ref)
-                                    dst = '%s/%s.json' % (annoDirTmp, ref)
-                                    if not os.path.exists(dst):
-                                        os.symlink(src, dst)
-                            refGenome = '%s/%s/%s.fa' % (blastDir, ref, ref)
-                            if not os.path.exists(refGenome):
-                                if os.path.islink(refGenome):
-                                    refGenome = os.path.realpath(refGenome)
-                                else:
-                                    sys.exit('%s not found!' % refGenome)
-                            checkFileExist(refGenome)
-                            fasJobs.append([s.id, ref, groupID, groupFa, annoDirTmp, outDir, refGenome, bidirectional, force])
-                            groupRefSpec[groupID].append(ref)
-                        ###### consensus approach
-                        # get consensus sequence
-                        groupAln = '%s/%s.aln' % (group, groupID)
-                        consensus = getConsensus(groupAln, 0.5)
-                        consensusFa = '%s/cons.fa' % annoDirTmp
-                        with open(consensusFa, 'w') as cf:
-                            cf.write('>consensus\n%s\n' % consensus)
-                        # do annotation for consensus sequence
-                        if not os.path.exists('%s/consensus.json' % (annoDirTmp)) or force:
-                            annoFAS(consensusFa, annoDirTmp, cpus, force)
-                        # add to fasJobsCons
-                        fasJobsCons.append([coreDir, coreSet, groupID, groupFa, consensusFa, annoDirTmp, outDir, force])
+                    # get annotation for ref genomes and path to ref genomes
+                    # one calcFAS job per ref spec, covering all of its sequences in this group
+                    refJobs = {}
+                    for seqID in seqIDs:
+                        ref = seqID.split('|')[1]
+                        if ref in refJobs:
+                            refJobs[ref][0].append(seqID)
+                            continue
+                        if not '%s.json' % ref in annoTmpFiles:
+                            if '%s.json' % ref in annoFiles:
+                                src = '%s/%s.json' % (annoDir, ref)
+                                dst = '%s/%s.json' % (annoDirTmp, ref)
+                                try:
+                                    os.symlink(src, dst)
+                                except FileExistsError:
+                                    pass
+                        refGenome = getRefGenome(blastDir, ref)
+                        refJobs[ref] = [[seqID], ref, groupID, groupFa, annoDirTmp, outDir, refGenome, bidirectional]
+                        groupRefSpec[groupID]['refs'].append(ref)
+                    # only queue calcFAS for ref specs without output
+                    newJobs = 0
+                    for ref in refJobs:
+                        if '%s.tsv' % ref in outFiles:
+                            if not force:
+                                continue
+                            os.remove('%s/%s.tsv' % (outDir, ref))
+                        fasJobs.append(refJobs[ref])
+                        newJobs += 1
+                    if newJobs > 0 and 'fasScores.pickle' in outFiles:
+                        os.remove('%s/fasScores.pickle' % outDir)
+                    ###### consensus approach
+                    # get consensus sequence
+                    groupAln = '%s/%s.aln' % (group, groupID)
+                    consensus = getConsensus(groupAln, 0.5)
+                    consensusFa = '%s/cons.fa' % annoDirTmp
+                    with open(consensusFa, 'w') as cf:
+                        cf.write('>consensus\n%s\n' % consensus)
+                    # do annotation for consensus sequence
+                    if not 'consensus.json' in annoTmpFiles or force:
+                        annoFAS(consensusFa, annoDirTmp, cpus, force)
+                    # add to fasJobsCons
+                    fasJobsCons.append([coreDir, coreSet, groupID, groupFa, consensusFa, annoDirTmp, outDir, force])
         else:
             sys.exit('No core group found at %s' % (coreDir + '/core_orthologs/' + coreSet))
     return(fasJobs, fasJobsCons, groupRefSpec)
 
 def calcFAS(args):
-    (queryID, refSpec, groupID, groupFa, annoDir, outputDir, ref, bidirectional, force) = args
-    flag = 0
-    if not os.path.exists('%s/%s.tsv' % (outputDir, refSpec)):
-        flag = 1
-    else:
-        if force:
-            os.remove('%s/%s.tsv' % (outputDir, refSpec))
-            flag = 1
-    if flag == 1:
-        # calculate fas scores for each sequence vs all
-        fasCmd = 'calcFAS -s \"%s\" -q \"%s\" --query_id \"%s\" -a %s -o %s -n %s --domain -r %s -t 10' % (groupFa, groupFa, queryID, annoDir, outputDir, refSpec, ref)
-        if bidirectional:
-            fasCmd = fasCmd + ' --bidirectional'
-        fasCmd = fasCmd + ' > /dev/null 2>&1'
-        try:
-            subprocess.run([fasCmd], shell=True, check=True)
-        except:
-            print('\033[91mProblem occurred while running calcFAS\033[0m\n%s' % fasCmd)
+    (queryIDs, refSpec, groupID, groupFa, annoDir, outputDir, ref, bidirectional) = args
+    # calculate fas scores for all sequences of refSpec vs all
+    fasCmd = ['calcFAS', '-s', groupFa, '-q', groupFa, '--query_id'] + queryIDs + ['-a', annoDir, '-o', outputDir, '-n', refSpec, '--domain', '-r', ref, '-t', '10']
+    if bidirectional:
+        fasCmd.append('--bidirectional')
+    try:
+        subprocess.run(fasCmd, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL, check=True)
+    except:
+        print('\033[91mProblem occurred while running calcFAS\033[0m\n%s' % ' '.join(fasCmd))
 
 def parseFasOut(fasOutDir, refSpecList):
-    fasScores = {}
-    fasScores['all'] = {}
+    fasScores = defaultdict(lambda: {'score': []})
+    fasScores['all'] = defaultdict(lambda: defaultdict(list))
     for refSpec in refSpecList:
         fasOut = fasOutDir + '/' + refSpec + '.tsv'
         if not os.path.exists(fasOut):
@@ -148,58 +250,66 @@ def parseFasOut(fasOutDir, refSpecList):
         else:
             if os.stat(fasOut).st_size == 0:
                 sys.exit('%s is empty! Probably calcFAS could not run correctly. Please check again!' % fasOut)
-        if not refSpec in fasScores:
-            fasScores[refSpec] = {}
-            fasScores[refSpec]['score'] = []
-        if not refSpec in fasScores['all']:
-            fasScores['all'][refSpec] = {}
-        with open(fasOut, 'r') as file:
-            for l in file.readlines():
+        refScores = fasScores[refSpec]
+        refPairs = fasScores['all'][refSpec]
+        with open(fasOut, 'r', buffering=1<<20) as file:
+            for l in file:
                 tmp = l.split('\t')
-                if refSpec in tmp[1]:
-                    if not refSpec in tmp[0]:
-                        # get query spec ID
-                        querySpec = tmp[0].split('|')[1]
-                        if not querySpec in fasScores:
-                            fasScores[querySpec] = {}
-                            fasScores[querySpec]['score'] = []
-                        if not querySpec in fasScores['all'][refSpec]:
-                            fasScores['all'][refSpec][querySpec] = []
+                # compare the spec field of the IDs, not substrings
+                refTmp = tmp[1].split('|')
+                if len(refTmp) > 1 and refTmp[1] == refSpec:
+                    # get query spec ID
+                    querySpec = tmp[0].split('|')[1]
+                    if not querySpec == refSpec:
                         # get scores for refSpec vs others
                         scores = tmp[2].split('/')
                         if scores[1] == 'NA':
-                            fasScores[refSpec]['score'].append(float(scores[0]))
-                            fasScores[refSpec]['gene'] = tmp[1]
-                            fasScores[querySpec]['score'].append(float(scores[0]))
-                            fasScores[querySpec]['gene'] = tmp[0]
-                            fasScores['all'][refSpec][querySpec].append(float(scores[0]))
+                            score = float(scores[0])
                         else:
-                            scores = list(map(float, scores))
-                            fasScores[refSpec]['score'].append(statistics.mean(scores))
-                            fasScores[refSpec]['gene'] = tmp[1]
-                            fasScores[querySpec]['score'].append(statistics.mean(scores))
-                            fasScores[querySpec]['gene'] = tmp[0]
-                            fasScores['all'][refSpec][querySpec].append(statistics.mean(scores))
+                            score = 0.5 * (float(scores[0]) + float(scores[1]))
+                        refScores['score'].append(score)
+                        refScores['gene'] = tmp[1]
+                        queryScores = fasScores[querySpec]
+                        queryScores['score'].append(score)
+                        queryScores['gene'] = tmp[0]
+                        refPairs[querySpec].append(score)
+    # back to plain dicts
+    fasScores['all'] = {refSpec: dict(fasScores['all'][refSpec]) for refSpec in fasScores['all']}
+    return(dict(fasScores))
+
+def getFasScores(fasOutDir, refSpecList, force):
+    # parsed fas scores are cached next to the tsv files; the cache is
+    # removed by prepareJob whenever calcFAS is rerun for the group
+    cache = '%s/fasScores.pickle' % fasOutDir
+    if os.path.exists(cache) and not force:
+        with open(cache, 'rb') as f:
+            (cachedRefs, fasScores) = pickle.load(f)
+        if cachedRefs == refSpecList:
+            return(fasScores)
+    fasScores = parseFasOut(fasOutDir, refSpecList)
+    with open(cache + '.tmp', 'wb') as f:
+        pickle.dump((refSpecList, fasScores), f, protocol=pickle.HIGHEST_PROTOCOL)
+    os.replace(cache + '.tmp', cache)
     return(fasScores)
 
 def getGroupPairs(scoreDict):
-    donePair = []
+    # mean of both directional scores for each unordered pair of taxa
+    keys = sorted(scoreDict)
     out = []
-    for s in scoreDict:
-        for q in scoreDict[s]:
-            if not (s+'_'+q in donePair or q+'_'+s in donePair):
-                out.append(statistics.mean((scoreDict[s][q][0], scoreDict[q][s][0])))
-                donePair.append(s+'_'+q)
+    for i, s in enumerate(keys):
+        for q in keys[i+1:]:
+            if q in scoreDict[s] and s in scoreDict[q]:
+                out.append(0.5 * (scoreDict[s][q][0] + scoreDict[q][s][0]))
     return(out)
 
 def parseConsFas(args):
     (coreDir, coreSet, groupID, groupFa, consensusFa, annoDirTmp, outDir, force) = args
     # calculate fas scores for each sequence (seed) vs consensus (query)
-    fasCmd = 'calcFAS -s \"%s\" -q \"%s\" -a %s -o %s -t 10 --raw --tsv --domain' % (groupFa, consensusFa, annoDirTmp, outDir)
+    fasCmd = ['calcFAS', '-s', groupFa, '-q', consensusFa, '-a', annoDirTmp, '-o', outDir, '-t', '10', '--raw', '--tsv', '--domain']
     try:
-        fasOut = subprocess.run([fasCmd], shell=True, capture_output=True, check=True)
+        fasOut = subprocess.run(fasCmd, capture_output=True, check=True)
     except:
-        print('\033[91mProblem occurred while running calcFAS\033[0m\n%s' % fasCmd)
+        print('\033[91mProblem occurred while running calcFAS\033[0m\n%s' % ' '.join(fasCmd))
     cutoffDir = '%s/core_orthologs/%s/%s/fas_dir/cutoff_dir' % (coreDir, coreSet, groupID)
     Path(cutoffDir).mkdir(parents=True, exist_ok=True)
     singleOut = open(cutoffDir + '/4.cutoff', 'w')
@@ -214,51 +324,61 @@ def parseConsFas(args):
             singleOut.write('%s\t%s\t%s\n' % (tmp[1].split('|')[1], roundTo4(float(tmp[3])), tmp[1]))
             allFas.append(float(tmp[3]))
     # and mean to 1.scores
-    groupOut.write('meanCons\t%s\n' % roundTo4(statistics.mean(allFas)))
-    groupOut.write('medianCons\t%s\n' % roundTo4(statistics.median(allFas)))
+    groupOut.write('meanCons\t%s\n' % roundTo4(float(np.mean(allFas))))
+    groupOut.write('medianCons\t%s\n' % roundTo4(float(np.median(allFas))))
     singleOut.close()
     groupOut.close()
 
 def calcCutoff(args):
-    (coreDir, coreSet, groupRefSpec, groupID) = args
-    EnvStats = importr('EnvStats')
+    # sys.exit in a pool worker would leave the pool waiting for the lost job,
+    # so the message is passed back to the main process instead
+    try:
+        writeCutoff(args)
+    except SystemExit as e:
+        return(str(e))
+
+def writeCutoff(args):
+    (coreDir, coreSet, groupInfo, groupID, force) = args
     cutoffDir = '%s/core_orthologs/%s/%s/fas_dir/cutoff_dir' % (coreDir, coreSet, groupID)
     Path(cutoffDir).mkdir(parents=True, exist_ok=True)
-    singleOut = open(cutoffDir + '/2.cutoff', 'w')
+    # write to temp files first, so a failed job never leaves cutoff files behind
+    singleOut = open(cutoffDir + '/2.cutoff.tmp', 'w')
     singleOut.write('taxa\tcutoff\tgene\n')
-    groupOut = open(cutoffDir + '/1.cutoff', 'w')
+    groupOut = open(cutoffDir + '/1.cutoff.tmp', 'w')
     groupOut.write('label\tvalue\n')
 
     # parse fas output into cutoffs
     fasOutDir = '%s/core_orthologs/%s/%s/fas_dir/fasscore_dir' % (coreDir, coreSet, groupID)
-    fasScores = parseFasOut(fasOutDir, groupRefSpec[groupID])
+    fasScores = getFasScores(fasOutDir, groupInfo['refs'], force)
     # print(groupID)
     for key in fasScores:
         if key == 'all':
             groupPair = getGroupPairs(fasScores[key])
-            tmp = FloatVector(groupPair)
-            ci = EnvStats.eexp(tmp, ci = 'TRUE')
-            limits = ci.rx2('interval').rx2('limits')
-            rateLCL = list(limits.rx2[1])
-            rateUCL = list(limits.rx2[2])
-            UCL = 1/rateLCL[0]
-            LCL = 1/rateUCL[0]
-            groupOut.write('median\t%s\n' % statistics.median(groupPair))
-            groupOut.write('mean\t%s\n' % statistics.mean(groupPair))
+            groupPair = np.fromiter(groupPair, dtype=np.float64)
+            if len(groupPair) == 0:
+                sys.exit('No pairwise FAS scores found for %s in %s! Probably calcFAS could not run correctly. Please check again!' % (groupID, fasOutDir))
+            # exact 95% CI of the exponential rate (as EnvStats::eexp with ci = TRUE)
+            n = len(groupPair)
+            total = float(np.sum(groupPair))
+            rateLCL = chi2.ppf(0.025, 2*n) / (2*total)
+            rateUCL = chi2.ppf(0.975, 2*n) / (2*total)
+            UCL = 1/rateLCL
+            LCL = 1/rateUCL
+            groupOut.write('median\t%s\n' % float(np.median(groupPair)))
+            groupOut.write('mean\t%s\n' % float(np.mean(groupPair)))
             groupOut.write('LCL\t%s\n' % LCL)
             groupOut.write('UCL\t%s\n' % UCL)
         else:
-            singleOut.write('%s\t%s\t%s\n' % (key, statistics.mean(fasScores[key]['score']), fasScores[key]['gene']))
+            singleOut.write('%s\t%s\t%s\n' % (key, float(np.mean(fasScores[key]['score'])), fasScores[key]['gene']))
     # get mean and stddev length for each group
-    groupFa = '%s/core_orthologs/%s/%s/%s.fa' % (coreDir, coreSet, groupID, groupID)
-    groupLen = []
-    for s in SeqIO.parse(groupFa, 'fasta'):
-        groupLen.append(len(s.seq))
-    groupOut.write('meanLen\t%s\n' % statistics.mean(groupLen))
-    groupOut.write('stdevLen\t%s\n' % statistics.stdev(groupLen))
+    groupLen = groupInfo['lengths']
+    groupOut.write('meanLen\t%s\n' % float(np.mean(groupLen)))
+    groupOut.write('stdevLen\t%s\n' % float(np.std(groupLen, ddof=1)))
 
     singleOut.close()
     groupOut.close()
+    os.replace(cutoffDir + '/2.cutoff.tmp', cutoffDir + '/2.cutoff')
+    os.replace(cutoffDir + '/1.cutoff.tmp', cutoffDir + '/1.cutoff')
 
 def calcGroupCutoff(args):
     coreDir = os.path.abspath(args.coreDir)
@@ -284,27 +404,38 @@ def calcGroupCutoff(args):
     (fasJobs, fasJobsCons, groupRefSpec) = prepareJob(coreDir, coreSet, annoDir, blastDir, bidirectional, force, cpus)
 
     print('Calculating fas scores...')
-    pool = mp.Pool(cpus)
-    if len(fasJobs) > 0:
-        fasOut = []
-        for _ in tqdm(pool.imap_unordered(calcFAS, fasJobs), total=len(fasJobs)):
-            fasOut.append(_)
-    if len(fasJobsCons) > 0:
-        fasOutCons = []
-        for _ in tqdm(pool.imap_unordered(parseConsFas, fasJobsCons), total=len(fasJobsCons)):
-            fasOutCons.append(_)
+    # calcFAS jobs only wait for their subprocess, threads are enough for them
+    with ThreadPool(cpus) as pool:
+        if len(fasJobs) > 0:
+            fasOut = []
+            for _ in tqdm(pool.imap_unordered(calcFAS, fasJobs), total=len(fasJobs)):
+                fasOut.append(_)
+        if len(fasJobsCons) > 0:
+            fasOutCons = []
+            for _ in tqdm(pool.imap_unordered(parseConsFas, fasJobsCons), total=len(fasJobsCons)):
+                fasOutCons.append(_)
+
+    with mp.Pool(cpus, maxtasksperchild=64) as pool:
+        if len(groupRefSpec) > 0:
+            print('Calculating cutoffs...')
+            cutoffJobs = []
+            for groupID in groupRefSpec:
+                cutoffJobs.append([coreDir, coreSet, groupRefSpec[groupID], groupID, force])
+            cutoffOut = []
+            if len(cutoffJobs) > 0:
+                chunk = max(1, len(cutoffJobs) // (cpus * 8))
+                for _ in tqdm(pool.imap_unordered(calcCutoff, cutoffJobs, chunksize=chunk), total=len(cutoffJobs)):
+                    cutoffOut.append(_)
+            errors = [e for e in cutoffOut if e]
+            if len(errors) > 0:
+                sys.exit('\n'.join(errors))
 
-    if len(groupRefSpec) > 0:
-        print('Calculating cutoffs...')
-        cutoffJobs = []
-        for groupID in groupRefSpec:
-            cutoffJobs.append([coreDir, coreSet, groupRefSpec, groupID])
-        cutoffOut = []
-        if len(cutoffJobs) > 0:
-            for _ in tqdm(pool.imap_unordered(calcCutoff, cutoffJobs), total=len(cutoffJobs)):
-                cutoffOut.append(_)
-            with open('%s/core_orthologs/%s/done.txt' % (coreDir, coreSet), 'w') as f:
-                f.write(str(datetime.now()))
+    # all groups have their cutoffs now (also when none was pending, e.g. after
+    # a run that stopped between the last cutoff and writing done.txt)
+    doneFile = '%s/core_orthologs/%s/done.txt' % (coreDir, coreSet)
+    if len(groupRefSpec) > 0 or not os.path.exists(doneFile):
+        with open(doneFile, 'w') as f:
+            f.write(str(datetime.now()))
 
 def main():
     version = '0.0.1'
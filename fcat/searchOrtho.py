@@ -19,16 +19,15 @@ import sys
 import os
 import argparse
 from pathlib import Path
-from Bio import SeqIO
 import subprocess
 import multiprocessing as mp
 import shutil
 from tqdm import tqdm
 import time
 import datetime
-import statistics
 import glob
 import tarfile
+from collections import defaultdict
 
 def checkFileExist(file, msg):
     if not os.path.exists(os.path.abspath(file)):
@@ -37,11 +36,10 @@ def checkFileExist(file, msg):
 def roundTo4(number):
     return("%.4f" % round(number, 4))
 
-def readFile(file):
+def iterLines(file):
+    # stream lines of a file instead of reading them all into a list
     with open(file, 'r') as f:
-        lines = f.readlines()
-        f.close()
-        return(lines)
+        yield from f
 
 def make_archive(source, destination, format):
         base = os.path.basename(destination)
@@ -49,9 +47,107 @@ def make_archive(source, destination, format):
         ext = '.'.join(base.split('.')[1:3] )
         archive_from = os.path.dirname(source)
         archive_to = os.path.basename(source.strip(os.sep))
+        # use parallel gzip if available
+        if format == 'gztar' and shutil.which('pigz'):
+            pigz = 'pigz -p %s' % mp.cpu_count()
+            subprocess.run(['tar', '--use-compress-program', pigz, '-cf', destination, '-C', archive_from, archive_to], check=True)
+            return
         shutil.make_archive(name, format, archive_from, archive_to)
         shutil.move('%s.%s' % (name, ext), destination)
 
+def unpack_archive(source, destination, format):
+        if format == 'gztar' and shutil.which('pigz'):
+            pigz = 'pigz -p %s' % mp.cpu_count()
+            subprocess.run(['tar', '--use-compress-program', pigz, '-xf', source, '-C', destination], check=True)
+            return
+        shutil.unpack_archive(source, destination, format)
+
+def parseFasta(lines):
+    # yield (seqID, seq) tuples without building SeqRecord objects
+    seqID = None
+    seq = []
+    for line in lines:
+        if line.startswith('>'):
+            if seqID is not None:
+                yield(seqID, ''.join(seq))
+            seqID = (line[1:].split(None, 1) or [''])[0]
+            seq = []
+        else:
+            seq.append(line.strip())
+    if seqID is not None:
+        yield(seqID, ''.join(seq))
+
+def iterFasta(file):
+    with open(file, 'r') as f:
+        yield from parseFasta(f)
+
+def fastCat(srcFile, dstHandle, size = None):
+    # append srcFile to an open binary file handle, in-kernel if possible
+    with open(srcFile, 'rb') as src:
+        dstHandle.flush()
+        offset = 0
+        try:
+            if size is None:
+                size = os.fstat(src.fileno()).st_size
+            while offset < size:
+                sent = os.sendfile(dstHandle.fileno(), src.fileno(), offset, size - offset)
+                if sent == 0:
+                    break
+                offset += sent
+        except (OSError, AttributeError):
+            src.seek(offset)
+            shutil.copyfileobj(src, dstHandle, length=1<<20)
+
+def scanFdogTree(fdogOutDir):
+    # get {refSpec: {groupID: size of groupID.extended.fa or None}} of fdog output dir
+    # with a single scan of each folder and one stat per group
+    fdogTree = {}
+    with os.scandir(fdogOutDir) as refEntries:
+        for refEntry in refEntries:
+            if refEntry.is_dir():
+                fdogTree[refEntry.name] = {}
+                with os.scandir(refEntry.path) as groupEntries:
+                    for g in groupEntries:
+                        if g.is_dir(follow_symlinks=False):
+                            try:
+                                size = os.stat('%s/%s.extended.fa' % (g.path, g.name)).st_size
+                            except FileNotFoundError:
+                                size = None
+                            fdogTree[refEntry.name][g.name] = size
+    return(fdogTree)
+
+def fastCopy(src, dst):
+    # hardlink src to dst if possible, otherwise symlink or copy it
+    if os.path.lexists(dst):
+        # never remove the input itself, e.g. if the query fasta is already the target
+        if os.path.exists(dst) and os.path.samefile(src, dst):
+            return
+        os.remove(dst)
+    try:
+        os.link(src, dst)
+    except OSError:
+        try:
+            os.symlink(os.path.abspath(src), dst)
+        except OSError:
+            shutil.copy(src, dst)
+
+def forceSymlink(src, dst):
+    # (re)create symlink dst -> src, skip if it already points to src
+    if os.path.islink(dst) and os.readlink(dst) == src:
+        return
+    tmp = '%s.tmp-%s' % (dst, os.getpid())
+    os.symlink(src, tmp)
+    try:
+        os.replace(tmp, dst)
+    except OSError:
+        os.unlink(tmp)
+        raise
+
+def isSpec(seqID, specID):
+    # check species field of a sequence ID (groupID|specID|protID...)
+    tmp = seqID.split('|', 2)
+    return(len(tmp) > 1 and tmp[1] == specID)
+
 def isInt(s):
     try:
         int(s)
@@ -64,11 +160,7 @@ def checkQueryAnno(annoQuery, annoDir):
     if not annoQuery == '':
         annoQuery = os.path.abspath(annoQuery)
         checkFileExist(annoQuery, '')
-        try:
-            os.symlink(annoQuery, annoDir+'/query.json')
-        except FileExistsError:
-            os.remove(annoDir+'/query.json')
-            os.symlink(annoQuery, annoDir+'/query.json')
+        forceSymlink(annoQuery, annoDir+'/query.json')
         doAnno = False
     return(doAnno)
 
@@ -79,46 +171,55 @@ def parseQueryFa(query, taxid, outDir, doAnno, annoDir, cpus):
         if taxid == '0':
             sys.exit('Query taxon does not have suitable ID format (e.g. HUMAN@9606@3). Please provide its taxonomy ID additionaly using --taxid option!')
         else:
-            addTaxon = 'fdog.addTaxon -f %s -i %s -o %s --replace --force' % (query, taxid, outDir)
+            addTaxon = ['fdog.addTaxon', '-f', query, '-i', taxid, '-o', outDir, '--replace', '--force']
             if doAnno == False:
-                addTaxon = addTaxon + ' --noAnno'
+                addTaxon.append('--noAnno')
             else:
                 print('Annotation for %s not given!' % queryID)
             try:
-                addTaxonOut = subprocess.run([addTaxon], shell=True, capture_output=True, check=True)
+                addTaxonOut = subprocess.run(addTaxon, capture_output=True, check=True)
             except:
-                sys.exit('Problem occurred while parsing query fasta file\n%s' % addTaxon)
+                sys.exit('Problem occurred while parsing query fasta file\n%s' % ' '.join(addTaxon))
             lines = addTaxonOut.stdout.decode().split('\n')
             queryID = lines[1].split('\t')[1]
     else:
         Path('%s/genome_dir/%s' % (outDir, queryID)).mkdir(parents=True, exist_ok=True)
-        shutil.copy(query, '%s/genome_dir/%s/%s.fa' % (outDir, queryID, queryID))
+        fastCopy(query, '%s/genome_dir/%s/%s.fa' % (outDir, queryID, queryID))
         checkedFile = open('%s/genome_dir/%s/%s.fa.checked' % (outDir, queryID, queryID), 'w')
         now = datetime.datetime.now()
         checkedFile.write(now.strftime("%Y-%m-%d %H:%M:%S"))
         checkedFile.close()
         if doAnno:
-            annoFAS = 'annoFAS -i %s -o %s --cpus %s > /dev/null 2>&1' % (query, annoDir, cpus)
+            annoFAS = ['annoFAS', '-i', query, '-o', annoDir, '--cpus', str(cpus)]
             try:
-                subprocess.run([annoFAS], shell=True, check=True)
+                subprocess.run(annoFAS, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL, check=True)
             except:
-                print('\033[91mProblem occurred while running annoFAS for query protein set\033[0m\n%s' % annoFAS)
+                print('\033[91mProblem occurred while running annoFAS for query protein set\033[0m\n%s' % ' '.join(annoFAS))
     return(queryID)
 
 def checkRefspec(refspecList, groupFa):
-    coreSpec = []
-    for s in SeqIO.parse(groupFa, 'fasta'):
-        ref = s.id.split('|')[1]
-        coreSpec.append(ref)
-    for r in refspecList:
-        if r in coreSpec:
-            return(r)
+    # get the first taxon of refspecList that is present in the core group
+    refIndex = {}
+    for i in range(len(refspecList)):
+        if not refspecList[i] in refIndex:
+            refIndex[refspecList[i]] = i
+    best = len(refspecList)
+    for (sID, sSeq) in iterFasta(groupFa):
+        ref = sID.split('|', 2)[1]
+        if ref in refIndex and refIndex[ref] < best:
+            best = refIndex[ref]
+            # stop reading as soon as the top ranked refspec is found
+            if best == 0:
+                break
+    if best < len(refspecList):
+        return(refspecList[best])
     return('')
 
 def readRefspecFile(refspecFile):
     groupRefspec = {}
-    for line in readFile(refspecFile):
-        groupRefspec[line.split('\t')[0]] = line.split('\t')[1].strip()
+    for line in iterLines(refspecFile):
+        (groupID, refspec) = line.split('\t', 1)
+        groupRefspec[groupID] = refspec.strip()
     return(groupRefspec)
 
 def prepareJob(coreDir, coreSet, queryID, refspecList, outDir, blastDir, annoDir, annoQuery, force, cpus):
@@ -148,14 +249,23 @@ def prepareJob(coreDir, coreSet, queryID, refspecList, outDir, blastDir, annoDir
 
 def runFdog(args):
     (seqFile, seqName, refSpec, outPath, blastPath, hmmPath, searchPath, force) = args
-    fdog = 'fdog.run --seqFile %s --seqName %s --refspec %s --outpath %s --blastpath %s --hmmpath %s --searchpath %s --fasoff --reuseCore --checkCoorthologsRef --cpu 1 > /dev/null 2>&1' % (seqFile, seqName, refSpec, outPath, blastPath, hmmPath, searchPath)
+    fdog = ['fdog.run', '--seqFile', seqFile, '--seqName', seqName, '--refspec', refSpec, '--outpath', outPath,
+            '--blastpath', blastPath, '--hmmpath', hmmPath, '--searchpath', searchPath,
+            '--fasoff', '--reuseCore', '--checkCoorthologsRef', '--cpu', '1']
     if force:
-        fdog = fdog + ' --force'
+        fdog.append('--force')
     try:
-        subprocess.run([fdog], shell=True, check=True)
+        subprocess.run(fdog, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL, check=True)
         os.remove(seqName + '.fa')
     except:
-        print('\033[91mProblem occurred while running fDOG for \'%s\' core group\033[0m\n%s' % (seqName, fdog))
+        print('\033[91mProblem occurred while running fDOG for \'%s\' core group\033[0m\n%s' % (seqName, ' '.join(fdog)))
+    # return the (small) extended.fa so that the main process can merge it right away
+    extendedFa = None
+    singleFa = '%s/%s/%s.extended.fa' % (outPath, seqName, seqName)
+    if os.path.exists(singleFa):
+        with open(singleFa, 'rb') as f:
+            extendedFa = f.read()
+    return(seqName, refSpec, outPath, extendedFa)
 
 def outputMode(outDir, coreSet, queryID, force, approach):
     phyloprofileDir = '%s/fcatOutput/%s/%s/phyloprofileOutput' % (outDir, coreSet, queryID)
@@ -169,190 +279,249 @@ def outputMode(outDir, coreSet, queryID, force, approach):
             mode = 0
     return(mode, phyloprofileDir)
 
-def calcFAS(coreDir, outDir, coreSet, queryID, annoDir, cpus, force):
+def runFdogFASForRefspec(args):
+    (refSpec, groups, fdogOutDir, annoDir, queryID, mode, cores, merged, force) = args
+    missing = []
+    lines = []
+    # merge single extended.fa files for each refspec (if not yet done during ortholog search)
+    refDir = fdogOutDir + '/' + refSpec
+    mergedFa = '%s/%s.extended.fa' % (refDir, refSpec)
+    if merged or not os.path.exists(mergedFa) or force:
+        if not merged:
+            mergedFaFile = open(mergedFa, 'wb', buffering=1<<20)
+            for groupID in groups:
+                singleFa = '%s/%s/%s.extended.fa' % (refDir, groupID, groupID)
+                if groups[groupID] is not None:
+                    fastCat(singleFa, mergedFaFile, groups[groupID])
+                else:
+                    missing.append(groupID)
+            mergedFaFile.close()
+        # calculate fas scores for merged extended.fa using fdogFAS
+        fdogFAS = ['fdogFAS', '-i', mergedFa, '-w', annoDir, '--cores', str(cores)]
+        try:
+            subprocess.run(fdogFAS, check=True)
+        except:
+            print('\033[91mProblem occurred while running fdogFAS for \'%s\'\033[0m\n%s' % (mergedFa, ' '.join(fdogFAS)))
+    # collect lines for phyloprofile output
+    if not mode == 0:
+        if os.path.exists('%s/%s.phyloprofile' % (refDir, refSpec)):
+            for line in iterLines('%s/%s.phyloprofile' % (refDir, refSpec)):
+                tmp = line.split('\t', 3)
+                if len(tmp) > 2 and isSpec(tmp[2], queryID):
+                    lines.append(line)
+    return(missing, lines)
+
+def processCoreGroup(args):
+    (groupID, refSpec, coreDir, coreSet) = args
+    # get profile lines of core sequences of a group vs. its refspec
+    lines = []
+    revCache = {}
+    coreFasDir = '%s/core_orthologs/%s/%s/fas_dir/fasscore_dir' % (coreDir, coreSet, groupID)
+    for fasFile in glob.glob('%s/*.tsv' % coreFasDir):
+        if not refSpec in fasFile:
+            for fLine in iterLines(fasFile):
+                tmp = fLine.rstrip('\n').split('\t')
+                if refSpec in tmp[0]:
+                    revFile = '%s/%s.tsv' % (coreFasDir, tmp[0].split('|')[1])
+                    # read each reverse fas file only once
+                    if not revFile in revCache:
+                        revCache[revFile] = {}
+                        with open(revFile, 'r') as rf:
+                            for revLine in rf:
+                                revTmp = revLine.split('\t')
+                                if len(revTmp) > 2:
+                                    revCache[revFile][revTmp[0]] = revTmp[2].split('/')[0]
+                    revFAS = revCache[revFile].get(tmp[1], 0)
+                    coreLine = '%s\t%s\t%s\t%s\t%s\n' % (groupID, 'ncbi' + tmp[1].split('|')[1].split('@')[1], tmp[1], tmp[2].split('/')[0], revFAS)
+                    lines.append(coreLine)
+    return(lines)
+
+def calcFAS(coreDir, outDir, coreSet, queryID, annoDir, cpus, force, fdogTree, mergedRefspec = ()):
     # output files
     (mode, phyloprofileDir) = outputMode(outDir, coreSet, queryID, force, 'other')
     if mode == 1 or mode == 3:
-        finalPhyloprofile = open('%s/mode23.phyloprofile' % (phyloprofileDir), 'w')
+        finalPhyloprofile = open('%s/mode23.phyloprofile' % (phyloprofileDir), 'w', buffering=1<<20)
         finalPhyloprofile.write('geneID\tncbiID\torthoID\tFAS_F\tFAS_B\n')
     elif mode == 2:
-        finalPhyloprofile = open('%s/mode23.phyloprofile' % (phyloprofileDir), 'a')
-    # parse single fdog output
+        finalPhyloprofile = open('%s/mode23.phyloprofile' % (phyloprofileDir), 'a', buffering=1<<20)
+    # parse single fdog output, one fdogFAS job for each refspec
     missing = []
     fdogOutDir = '%s/fcatOutput/%s/%s/fdogOutput' % (outDir, coreSet, queryID)
-    out = os.listdir(fdogOutDir)
-    for refSpec in out:
-        if os.path.isdir(fdogOutDir + '/' + refSpec):
-            # merge single extended.fa files for each refspec
-            refDir = fdogOutDir + '/' + refSpec
-            groups = os.listdir(refDir)
-            mergedFa = '%s/%s.extended.fa' % (refDir, refSpec)
-            if not os.path.exists(mergedFa) or force:
-                mergedFaFile = open(mergedFa, 'wb')
-                for groupID in groups:
-                    if os.path.isdir(refDir + '/' + groupID):
-                        singleFa = '%s/%s/%s.extended.fa' % (refDir, groupID, groupID)
-                        if os.path.exists(singleFa):
-                            shutil.copyfileobj(open(singleFa, 'rb'), mergedFaFile)
-                        else:
-                            missing.append(groupID)
-                mergedFaFile.close()
-                # calculate fas scores for merged extended.fa using fdogFAS
-                fdogFAS = 'fdogFAS -i %s -w %s --cores %s' % (mergedFa, annoDir, cpus)
-                try:
-                    subprocess.run([fdogFAS], shell=True, check=True)
-                except:
-                    print('\033[91mProblem occurred while running fdogFAS for \'%s\'\033[0m\n%s' % (mergedFa, fdogFAS))
-            # move to phyloprofile output dir
-            if not mode == 0:
-                if os.path.exists('%s/%s.phyloprofile' % (refDir, refSpec)):
-                    for line in readFile('%s/%s.phyloprofile' % (refDir, refSpec)):
-                        if queryID in line:
-                            finalPhyloprofile.write(line)
-                # append profile of core sequences
-                for groupID in groups:
-                    coreFasDir = '%s/core_orthologs/%s/%s/fas_dir/fasscore_dir' % (coreDir, coreSet, groupID)
-                    for fasFile in glob.glob('%s/*.tsv' % coreFasDir):
-                        if not refSpec in fasFile:
-                            for fLine in readFile(fasFile):
-                                if refSpec in fLine.split('\t')[0]:
-                                    tmp = fLine.split('\t')
-                                    revFAS = 0
-                                    revFile = '%s/%s.tsv' % (coreFasDir, tmp[0].split('|')[1])
-                                    for revLine in readFile(revFile):
-                                        if tmp[1] == revLine.split('\t')[0]:
-                                            revFAS = revLine.split('\t')[2].split('/')[0]
-                                    coreLine = '%s\t%s\t%s\t%s\t%s\n' % (groupID, 'ncbi' + str(tmp[1].split('|')[1].split('@')[1]), tmp[1], tmp[2].split('/')[0], revFAS)
-                                    finalPhyloprofile.write(coreLine)
+    if len(fdogTree) > 0:
+        poolSize = max(1, min(cpus, len(fdogTree)))
+        cores = max(1, cpus // poolSize)
+        fasJobs = [(r, fdogTree[r], fdogOutDir, annoDir, queryID, mode, cores, r in mergedRefspec, force) for r in fdogTree]
+        # only the main process writes into the final phyloprofile file
+        with mp.Pool(poolSize) as pool:
+            for (missingRef, lines) in pool.imap_unordered(runFdogFASForRefspec, fasJobs, chunksize=1):
+                missing.extend(missingRef)
+                if not mode == 0:
+                    finalPhyloprofile.writelines(lines)
+    # append profile of core sequences
     if not mode == 0:
+        coreJobs = [(g, r, coreDir, coreSet) for r in fdogTree for g in fdogTree[r]]
+        if len(coreJobs) > 0:
+            chunk = max(1, len(coreJobs) // (cpus * 4))
+            with mp.Pool(cpus) as pool:
+                for lines in pool.imap_unordered(processCoreGroup, coreJobs, chunksize=chunk):
+                    finalPhyloprofile.writelines(lines)
         finalPhyloprofile.close()
     return(missing)
 
-def calcFASall(coreDir, outDir, coreSet, queryID, annoDir, cpus, force, groupRefspec):
+def getQueryOrthologs(fdogOutDir, queryID, fdogTree):
+    # get ortholog seqs of query species from single extended.fa files of each core group
+    queryOrthologs = {}
+    for refSpec in fdogTree:
+        refDir = fdogOutDir + '/' + refSpec
+        for groupID in fdogTree[refSpec]:
+            singleFa = '%s/%s/%s.extended.fa' % (refDir, groupID, groupID)
+            if fdogTree[refSpec][groupID] is not None:
+                queryOrthologs[groupID] = [(sID, sSeq) for (sID, sSeq) in iterFasta(singleFa) if isSpec(sID, queryID)]
+    return(queryOrthologs)
+
+def calcFASall(coreDir, outDir, coreSet, queryID, annoDir, cpus, force, groupRefspec, fdogTree, queryOrthologs = None):
     # output files
     phyloprofileDir = '%s/fcatOutput/%s/%s/phyloprofileOutput' % (outDir, coreSet, queryID)
     (mode, phyloprofileDir) = outputMode(outDir, coreSet, queryID, force, 'mode1')
     if mode == 1 or mode == 3:
-        finalFa = open('%s/%s.mod.fa' % (phyloprofileDir, coreSet), 'w')
+        finalFa = open('%s/%s.mod.fa' % (phyloprofileDir, coreSet), 'w', buffering=1<<20)
         finalFwdDomain = open('%s/FAS_forward.domains' % (phyloprofileDir), 'wb')
-        finalPhyloprofile = open('%s/mode1.phyloprofile' % (phyloprofileDir), 'w')
+        finalPhyloprofile = open('%s/mode1.phyloprofile' % (phyloprofileDir), 'w', buffering=1<<20)
         finalPhyloprofile.write('geneID\tncbiID\torthoID\tFAS_MEAN\n')
-        finalLen = open('%s/length.phyloprofile' % (phyloprofileDir), 'w')
+        finalLen = open('%s/length.phyloprofile' % (phyloprofileDir), 'w', buffering=1<<20)
         finalLen.write('geneID\tncbiID\torthoID\tLength\n')
     elif mode == 2:
-        finalFa = open('%s/%s.mod.fa' % (phyloprofileDir, coreSet), 'a')
+        finalFa = open('%s/%s.mod.fa' % (phyloprofileDir, coreSet), 'a', buffering=1<<20)
         finalFwdDomain = open('%s/FAS_forward.domains' % (phyloprofileDir), 'ab')
-        finalPhyloprofile = open('%s/mode1.phyloprofile' % (phyloprofileDir), 'a')
-        finalLen = open('%s/length.phyloprofile' % (phyloprofileDir), 'a')
+        finalPhyloprofile = open('%s/mode1.phyloprofile' % (phyloprofileDir), 'a', buffering=1<<20)
+        finalLen = open('%s/length.phyloprofile' % (phyloprofileDir), 'a', buffering=1<<20)
     # create file for fdogFAS
     fdogOutDir = '%s/fcatOutput/%s/%s/fdogOutput' % (outDir, coreSet, queryID)
     mergedFa = '%s/%s_all.extended.fa' % (fdogOutDir, queryID)
-    count = {}
+    count = defaultdict(int)
+    mergedRecords = []
     if not os.path.exists(mergedFa) or force:
-        mergedFaFile = open(mergedFa, 'w')
-        out = os.listdir(fdogOutDir)
-        for refSpec in out:
-            if os.path.isdir(fdogOutDir + '/' + refSpec):
-                refDir = fdogOutDir + '/' + refSpec
-                groups = os.listdir(refDir)
-                for groupID in groups:
-                    if os.path.isdir(refDir + '/' + groupID):
-                        # merge each ortholog seq in single extended.fa file with core group fasta file
-                        # and write into mergedFaFile
-                        groupFa = '%s/core_orthologs/%s/%s/%s.fa' % (coreDir, coreSet, groupID, groupID)
-                        singleFa = '%s/%s/%s.extended.fa' % (refDir, groupID, groupID)
-                        if os.path.exists(singleFa):
-                            for s in SeqIO.parse(singleFa, 'fasta'):
-                                specID = s.id.split('|')[1]
-                                if specID == queryID:
-                                    if not groupID in count:
-                                        count[groupID] = 1
-                                    else:
-                                        count[groupID] = count[groupID]  + 1
-                                    id  = str(count[groupID]) + '_' + s.id
-                                    mergedFaFile.write('>%s\n%s\n' % (id, s.seq))
-                                    for c in SeqIO.parse(groupFa, 'fasta'):
-                                        mergedFaFile.write('>%s_%s|1\n%s\n' % (count[groupID], c.id, c.seq))
-                        # delete single fdog out
-                        # shutil.rmtree('%s/%s' % (refDir, groupID))
+        if queryOrthologs is None:
+            queryOrthologs = getQueryOrthologs(fdogOutDir, queryID, fdogTree)
+        mergedFaFile = open(mergedFa, 'w', buffering=1<<20)
+        for groupID in queryOrthologs:
+            # merge each ortholog seq with core group fasta file and write into mergedFaFile
+            groupFa = '%s/core_orthologs/%s/%s/%s.fa' % (coreDir, coreSet, groupID, groupID)
+            buf = []
+            coreRecords = None
+            for (sID, sSeq) in queryOrthologs[groupID]:
+                count[groupID] += 1
+                idx = count[groupID]
+                id  = str(idx) + '_' + sID
+                buf.append(f'>{id}\n{sSeq}\n')
+                mergedRecords.append((id, sSeq))
+                # parse core group fasta only once for all orthologs of this group
+                if coreRecords is None:
+                    coreRecords = list(iterFasta(groupFa))
+                for (cID, cSeq) in coreRecords:
+                    cIDmod = f'{idx}_{cID}|1'
+                    buf.append(f'>{cIDmod}\n{cSeq}\n')
+                    mergedRecords.append((cIDmod, cSeq))
+            mergedFaFile.writelines(buf)
         mergedFaFile.close()
         # calculate fas scores for merged _all.extended.fa using fdogFAS
-        fdogFAS = 'fdogFAS -i %s -w %s --cores %s' % (mergedFa, annoDir, cpus)
+        fdogFAS = ['fdogFAS', '-i', mergedFa, '-w', annoDir, '--cores', str(cpus)]
         try:
-            subprocess.run([fdogFAS], shell=True, check=True)
+            subprocess.run(fdogFAS, check=True)
         except:
-            print('\033[91mProblem occurred while running fdogFAS for \'%s\'\033[0m\n%s' % (mergedFa, fdogFAS))
+            print('\033[91mProblem occurred while running fdogFAS for \'%s\'\033[0m\n%s' % (mergedFa, ' '.join(fdogFAS)))
     # move to phyloprofile output dir
     if not mode == 0:
         # phyloprofile file
+        # running sums of forward and backward scores, and number of core seqs for each group
         groupScoreFwd = {}
         groupScoreRev = {}
+        groupCount = {}
         groupOrtho = {}
-        for line in readFile('%s/%s_all.phyloprofile' % (fdogOutDir, queryID)):
-            if not line.split('\t')[0] == 'geneID':
-                groupID = line.split('\t')[0]
-                if not groupID in groupScoreFwd:
-                    groupScoreFwd[groupID] = []
-                    groupScoreRev[groupID] = []
-                if queryID in line.split('\t')[2]:
-                    groupOrtho[groupID] = line.split('\t')[2]
-                else:
-                    groupScoreFwd[groupID].append(float(line.split('\t')[3]))
-                    groupScoreRev[groupID].append(float(line.split('\t')[4]))
+        for line in iterLines('%s/%s_all.phyloprofile' % (fdogOutDir, queryID)):
+            parts = line.rstrip('\n').split('\t')
+            if parts[0] == 'geneID':
+                continue
+            (groupID, orthoID, fwd, rev) = (parts[0], parts[2], parts[3], parts[4])
+            if not groupID in groupScoreFwd:
+                groupScoreFwd[groupID] = 0.0
+                groupScoreRev[groupID] = 0.0
+                groupCount[groupID] = 0
+            if isSpec(orthoID, queryID):
+                groupOrtho[groupID] = orthoID
+            else:
+                groupScoreFwd[groupID] += float(fwd)
+                groupScoreRev[groupID] += float(rev)
+                groupCount[groupID] += 1
+        queryNcbiID = 'ncbi' + queryID.split('@')[1]
         for groupID in groupOrtho:
             # calculate mean fas score for ortholog
             groupIDmod = '_'.join(groupID.split('_')[1:])
             groupOrthoMod = '_'.join(groupOrtho[groupID].split('_')[1:])
-            newline = '%s\t%s\t%s\t%s\n' % (groupIDmod, 'ncbi' + str(queryID.split('@')[1]), groupOrthoMod, statistics.mean((statistics.mean(groupScoreFwd[groupID]), statistics.mean(groupScoreRev[groupID]))))
-            finalPhyloprofile.write(newline)
+            meanFas = (groupScoreFwd[groupID] + groupScoreRev[groupID]) / (2 * groupCount[groupID])
+            buf = [f'{groupIDmod}\t{queryNcbiID}\t{groupOrthoMod}\t{meanFas}\n']
             # append profile of core sequences
             meanCoreFile = '%s/core_orthologs/%s/%s/fas_dir/cutoff_dir/2.cutoff' % (coreDir, coreSet, groupIDmod)
-            for tax in readFile(meanCoreFile):
-                if not tax.split('\t')[0] == 'taxa':
-                    if not tax.split('\t')[0] == groupRefspec[groupIDmod]:
-                        ppCore = '%s\t%s\t%s|1\t%s\n' % (groupIDmod, 'ncbi' + str(tax.split('\t')[0].split('@')[1]), tax.split('\t')[2].strip(), tax.split('\t')[1])
-                        finalPhyloprofile.write(ppCore)
+            refspec = groupRefspec[groupIDmod]
+            for tax in iterLines(meanCoreFile):
+                (taxa, cutoff, gene) = tax.rstrip('\n').split('\t', 2)
+                if taxa == 'taxa' or taxa == refspec:
+                    continue
+                taxID = taxa.split('@', 2)[1]
+                buf.append(f'{groupIDmod}\tncbi{taxID}\t{gene}|1\t{cutoff}\n')
+            finalPhyloprofile.writelines(buf)
         finalPhyloprofile.close()
         # length phyloprofile file and final fasta file
-        for s in SeqIO.parse(mergedFa, 'fasta'):
-            idMod = '_'.join(s.id.split('_')[1:])
-            if not idMod.split('|')[1] == groupRefspec[idMod.split('|')[0]]:
-                finalFa.write('>%s\n%s\n' % (idMod, s.seq))
-                ppLen = '%s\t%s\t%s\t%s\n' % (idMod.split('|')[0], 'ncbi' + str(idMod.split('|')[1].split('@')[1]), idMod, len(s.seq))
-                finalLen.write(ppLen)
+        # reuse merged records if they were just written, otherwise read them from mergedFa
+        if len(mergedRecords) == 0:
+            mergedRecords = list(iterFasta(mergedFa))
+        faBuf = []
+        lenBuf = []
+        for (sID, sSeq) in mergedRecords:
+            idMod = '_'.join(sID.split('_')[1:])
+            (groupIDmod, specID) = idMod.split('|')[:2]
+            if not specID == groupRefspec[groupIDmod]:
+                faBuf.append(f'>{idMod}\n{sSeq}\n')
+                lenBuf.append(f'{groupIDmod}\tncbi{specID.split("@")[1]}\t{idMod}\t{len(sSeq)}\n')
+        finalFa.writelines(faBuf)
+        finalLen.writelines(lenBuf)
         finalFa.close()
         finalLen.close()
         # join domain files
-        shutil.copyfileobj(open('%s/%s_all_forward.domains' % (fdogOutDir, queryID), 'rb'), finalFwdDomain)
+        fastCat('%s/%s_all_forward.domains' % (fdogOutDir, queryID), finalFwdDomain)
         finalFwdDomain.close()
-        finalDomain = open('%s/FAS.domains' % (phyloprofileDir), 'w')
-        for domains in readFile('%s/FAS_forward.domains' % (phyloprofileDir)):
-            tmp = domains.split('\t')
-            mGroup = '_'.join(tmp[0].split('#')[0].split('_')[1:])
-            mQuery = '_'.join(tmp[0].split('#')[1].split('_')[1:])
-            mSeed = '_'.join(tmp[1].split('_')[1:])
-            domainLine = '%s\t%s\t%s\t%s\t%s\t%s\tNA\tN\n' % (mGroup+'#'+mQuery, mSeed, tmp[2], tmp[3], tmp[4], tmp[5])
-            finalDomain.write(domainLine)
-        finalDomain.close()
+        with open('%s/FAS.domains' % (phyloprofileDir), 'w', buffering=1<<20) as finalDomain:
+            buf = []
+            for domains in iterLines('%s/FAS_forward.domains' % (phyloprofileDir)):
+                tmp = domains.split('\t', 6)
+                (pairGroup, pairQuery) = tmp[0].split('#', 1)
+                mGroup = pairGroup.split('_', 1)[1]
+                mQuery = pairQuery.split('_', 1)[1]
+                mSeed = tmp[1].split('_', 1)[1]
+                buf.append(f'{mGroup}#{mQuery}\t{mSeed}\t{tmp[2]}\t{tmp[3]}\t{tmp[4]}\t{tmp[5]}\tNA\tN\n')
+                if len(buf) >= 10000:
+                    finalDomain.writelines(buf)
+                    buf.clear()
+            finalDomain.writelines(buf)
         os.remove('%s/FAS_forward.domains' % (phyloprofileDir))
 
 def calcFAScmd(args):
     (seed, seedIDs, query, anno, out, name) = args
     if not os.path.exists('%s/%s.tsv' % (out, name)):
-        cmd = 'calcFAS -s %s --seed_id %s -q %s -a %s -o %s --cpus 1 -n %s --domain > /dev/null 2>&1' % (seed, seedIDs, query, anno, out, name)
+        cmd = ['calcFAS', '-s', seed, '--seed_id'] + seedIDs + ['-q', query, '-a', anno, '-o', out, '--cpus', '1', '-n', name, '--domain']
         try:
-            subprocess.run([cmd], shell=True, check=True)
+            subprocess.run(cmd, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL, check=True)
         except:
-            print('\033[91mProblem occurred while running calcFAS\033[0m\n%s' % (cmd))
+            print('\033[91mProblem occurred while running calcFAS\033[0m\n%s' % ' '.join(cmd))
 
-def calcFAScons(coreDir, outDir, coreSet, queryID, annoDir, cpus, force):
+def calcFAScons(coreDir, outDir, coreSet, queryID, annoDir, cpus, force, fdogTree):
     # output files
     (mode, phyloprofileDir) = outputMode(outDir, coreSet, queryID, force, 'other')
     if mode == 1 or mode == 3:
-        finalPhyloprofile = open('%s/mode4.phyloprofile' % (phyloprofileDir), 'w')
+        finalPhyloprofile = open('%s/mode4.phyloprofile' % (phyloprofileDir), 'w', buffering=1<<20)
         finalPhyloprofile.write('geneID\tncbiID\torthoID\tFAS\n')
     elif mode == 2:
-        finalPhyloprofile = open('%s/mode4.phyloprofile' % (phyloprofileDir), 'a')
+        finalPhyloprofile = open('%s/mode4.phyloprofile' % (phyloprofileDir), 'a', buffering=1<<20)
     # parse single fdog output
     missing = []
     fdogOutDir = '%s/fcatOutput/%s/%s/fdogOutput' % (outDir, coreSet, queryID)
@@ -364,70 +533,61 @@ def calcFAScons(coreDir, outDir, coreSet, queryID, annoDir, cpus, force):
     Path(fasDirOutTmp).mkdir(parents=True, exist_ok=True)
 
     fdogOutDir = '%s/fcatOutput/%s/%s/fdogOutput' % (outDir, coreSet, queryID)
-    out = os.listdir(fdogOutDir)
     missing = []
-    for refSpec in out:
-        if os.path.isdir(fdogOutDir + '/' + refSpec):
-            # make calcFAS job for founded orthologs and consensus seq of each group
-            refDir = fdogOutDir + '/' + refSpec
-            groups = os.listdir(refDir)
-            groupFa = '%s/%s.fa' % (annoDirTmp, refSpec)
-            groupFaFile = open(groupFa, 'w')
-            for groupID in groups:
-                if os.path.isdir(refDir + '/' + groupID):
-                    # get seed and query fasta
-                    singleFa = '%s/%s/%s.extended.fa' % (refDir, groupID, groupID)
-                    if os.path.exists(singleFa):
-                        consFa = '%s/core_orthologs/%s/%s/fas_dir/annotation_dir/cons.fa' % (coreDir, coreSet, groupID)
-                        consFaLink = '%s/cons_%s.fa' % (annoDirTmp, groupID)
-                        checkFileExist(consFa, '')
-                        try:
-                            os.symlink(consFa, consFaLink)
-                        except FileExistsError:
-                            os.remove(consFaLink)
-                            os.symlink(consFa, consFaLink)
-                        seedID = []
-                        for s in SeqIO.parse(singleFa, 'fasta'):
-                            if queryID in s.id:
-                                idTmp = s.id.split('|')
-                                seedID.append(idTmp[-2])
-                                groupFaFile.write('>%s\n%s\n' % (idTmp[-2], s.seq))
-                        # get annotations for seed and query
-                        consJson = '%s/core_orthologs/%s/%s/fas_dir/annotation_dir/cons.json' % (coreDir, coreSet, groupID)
-                        consJsonLink = '%s/cons_%s.json' % (annoDirTmp, groupID)
-                        checkFileExist(consJson, '')
-                        try:
-                            os.symlink(consJson, consJsonLink)
-                        except FileExistsError:
-                            os.remove(consJsonLink)
-                            os.symlink(consJson, consJsonLink)
-                        # tmp fas output
-                        calcFASjob.append([groupFa, ' '.join(seedID), consFaLink, annoDirTmp, fasDirOutTmp, groupID])
-                    else:
-                        missing.append(groupID)
-            groupFaFile.close()
-            # get annotation for orthologs
-            if not os.path.exists('%s/%s.json' % (annoDirTmp, refSpec)):
-                extractAnnoCmd = 'annoFAS -i %s -o %s -e -a %s/%s.json -n %s > /dev/null 2>&1' % (groupFa, annoDirTmp, annoDir, queryID, refSpec)
-                try:
-                    subprocess.run([extractAnnoCmd], shell=True, check=True)
-                except:
-                    print('\033[91mProblem occurred while running extracting annotation for \'%s\'\033[0m\n%s' % (seedFa, extractAnnoCmd))
+    for refSpec in fdogTree:
+        # make calcFAS job for founded orthologs and consensus seq of each group
+        refDir = fdogOutDir + '/' + refSpec
+        groupFa = '%s/%s.fa' % (annoDirTmp, refSpec)
+        groupFaFile = open(groupFa, 'w')
+        for groupID in fdogTree[refSpec]:
+            # get seed and query fasta
+            singleFa = '%s/%s/%s.extended.fa' % (refDir, groupID, groupID)
+            if fdogTree[refSpec][groupID] is not None:
+                consFa = '%s/core_orthologs/%s/%s/fas_dir/annotation_dir/cons.fa' % (coreDir, coreSet, groupID)
+                consFaLink = '%s/cons_%s.fa' % (annoDirTmp, groupID)
+                checkFileExist(consFa, '')
+                forceSymlink(consFa, consFaLink)
+                seedID = []
+                for (sID, sSeq) in iterFasta(singleFa):
+                    if isSpec(sID, queryID):
+                        idTmp = sID.split('|')
+                        seedID.append(idTmp[-2])
+                        groupFaFile.write('>%s\n%s\n' % (idTmp[-2], sSeq))
+                # get annotations for seed and query
+                consJson = '%s/core_orthologs/%s/%s/fas_dir/annotation_dir/cons.json' % (coreDir, coreSet, groupID)
+                consJsonLink = '%s/cons_%s.json' % (annoDirTmp, groupID)
+                checkFileExist(consJson, '')
+                forceSymlink(consJson, consJsonLink)
+                # tmp fas output
+                calcFASjob.append([groupFa, seedID, consFaLink, annoDirTmp, fasDirOutTmp, groupID])
+            else:
+                missing.append(groupID)
+        groupFaFile.close()
+        # get annotation for orthologs
+        if not os.path.exists('%s/%s.json' % (annoDirTmp, refSpec)):
+            extractAnnoCmd = ['annoFAS', '-i', groupFa, '-o', annoDirTmp, '-e', '-a', '%s/%s.json' % (annoDir, queryID), '-n', refSpec]
+            try:
+                subprocess.run(extractAnnoCmd, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL, check=True)
+            except:
+                print('\033[91mProblem occurred while running extracting annotation for \'%s\'\033[0m\n%s' % (groupFa, ' '.join(extractAnnoCmd)))
     # do FAS calculation
-    pool = mp.Pool(cpus)
     calcFASout = []
-    for _ in tqdm(pool.imap_unordered(calcFAScmd, calcFASjob), total=len(calcFASjob)):
-        calcFASout.append(_)
+    chunk = max(1, len(calcFASjob) // (cpus * 4))
+    with mp.Pool(cpus) as pool:
+        for _ in tqdm(pool.imap_unordered(calcFAScmd, calcFASjob, chunksize=chunk), total=len(calcFASjob)):
+            calcFASout.append(_)
     # parse fas output into phyloprofile
+    ncbiID = 'ncbi' + str(queryID.split('@')[1])
     for tsv in os.listdir(fasDirOutTmp):
         if os.path.isfile('%s/%s' % (fasDirOutTmp, tsv)):
-            for line in readFile('%s/%s' % (fasDirOutTmp, tsv)):
-                if not line.split('\t')[0] == 'Seed':
-                    groupID = tsv.split('.')[0]
-                    ncbiID = 'ncbi' + str(queryID.split('@')[1])
-                    orthoID = line.split('\t')[0]
-                    fas = roundTo4(float(line.split('\t')[2].split('/')[0]))
-                    finalPhyloprofile.write('%s\t%s\t%s\t%s\n' % (groupID, ncbiID, orthoID, fas))
+            groupID = tsv.split('.')[0]
+            buf = []
+            for line in iterLines('%s/%s' % (fasDirOutTmp, tsv)):
+                tmp = line.split('\t')
+                if not tmp[0] == 'Seed':
+                    fas = roundTo4(float(tmp[2].split('/')[0]))
+                    buf.append(f'{groupID}\t{ncbiID}\t{tmp[0]}\t{fas}\n')
+            finalPhyloprofile.writelines(buf)
     finalPhyloprofile.close()
 
 def checkResult(fcatOut, force):
@@ -492,13 +652,28 @@ def searchOrtho(args):
 
     print('Preparing...')
     groupRefspec = {}
+    missing = []
+    mergedFaFiles = {}
+    queryOrthologs = None
     if status == 0:
         (fdogJobs, ignored, groupRefspec) = prepareJob(coreDir, coreSet, queryID, refspecList, outDir, blastDir, annoDir, annoQuery, force, cpus)
         print('Searching orthologs...')
-        pool = mp.Pool(cpus)
-        fdogOut = []
-        for _ in tqdm(pool.imap_unordered(runFdog, fdogJobs), total=len(fdogJobs)):
-            fdogOut.append(_)
+        queryOrthologs = {}
+        chunk = max(1, len(fdogJobs) // (cpus * 4))
+        with mp.Pool(cpus) as pool:
+            for (groupID, refSpec, outPath, extendedFa) in tqdm(pool.imap_unordered(runFdog, fdogJobs, chunksize=chunk), total=len(fdogJobs)):
+                # merge each finished group into the extended.fa of its refspec
+                # and keep its query orthologs for calcFASall
+                if not refSpec in mergedFaFiles:
+                    Path(outPath).mkdir(parents=True, exist_ok=True)
+                    mergedFaFiles[refSpec] = open('%s/%s.extended.fa' % (outPath, refSpec), 'wb', buffering=1<<20)
+                if extendedFa is None:
+                    missing.append(groupID)
+                    continue
+                mergedFaFiles[refSpec].write(extendedFa)
+                queryOrthologs[groupID] = [(sID, sSeq) for (sID, sSeq) in parseFasta(extendedFa.decode().splitlines()) if isSpec(sID, queryID)]
+        for refSpec in mergedFaFiles:
+            mergedFaFiles[refSpec].close()
         # write ignored groups and refspec for each group based on given refspec list
         if len(ignored) > 0:
             # print('\033[92mNo species in %s found in core set(s): %s\033[0m' % (refspecList, ','.join(ignored)))
@@ -513,18 +688,19 @@ def searchOrtho(args):
             refspecFile.close()
     elif status == 1:
         # untar old fdog output to create phyloprofile files
-        shutil.unpack_archive('%s/fdogOutput.tar.gz' % fcatOut, fcatOut + '/', 'gztar')
+        unpack_archive('%s/fdogOutput.tar.gz' % fcatOut, fcatOut + '/', 'gztar')
 
     if not status == 2:
         if len(groupRefspec) == 0:
             if os.path.exists('%s/last_refspec.txt' % fcatOut):
                 groupRefspec = readRefspecFile('%s/last_refspec.txt' % fcatOut)
         print('Calculating pairwise FAS scores between query orthologs and sequences of refspec...')
-        missing = calcFAS(coreDir, outDir, coreSet, queryID, annoDir, cpus, force)
+        fdogTree = scanFdogTree('%s/fdogOutput' % fcatOut)
+        missing.extend(calcFAS(coreDir, outDir, coreSet, queryID, annoDir, cpus, force, fdogTree, mergedFaFiles))
         print('Calculating FAS scores between query orthologs and all sequences in each core group...')
-        calcFASall(coreDir, outDir, coreSet, queryID, annoDir, cpus, force, groupRefspec)
+        calcFASall(coreDir, outDir, coreSet, queryID, annoDir, cpus, force, groupRefspec, fdogTree, queryOrthologs)
         print('Calculating FAS scores between query orthologs and consensus sequence in each core group...')
-        calcFAScons(coreDir, outDir, coreSet, queryID, annoDir, cpus, force)
+        calcFAScons(coreDir, outDir, coreSet, queryID, annoDir, cpus, force, fdogTree)
         # remove tmp folder
         if os.path.exists('%s/tmp' % fcatOut):
             shutil.rmtree('%s/tmp' % fcatOut)
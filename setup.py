@@ -38,12 +38,13 @@ setup(
     package_data={'': ['*']},
     install_requires=[
         'biopython',
+        'numpy',
+        'scipy',
         'tqdm',
         'ete3',
         'six',
         'greedyFAS>=1.4.0',
-        'fdog>=0.0.8',
-        'rpy2'
+        'fdog>=0.0.8'
     ],
     entry_points={
         'console_scripts': ["fcat = fcat.fcat:main",